@@ -1,20 +1,79 @@
+import asyncio
+import glob
+import io
 import logging
+import mimetypes
 import os
-import subprocess
+import re
+import signal
 import tempfile
-import json
+import threading
+import time
+import uuid
 from typing import Optional
+from urllib.parse import urlparse, parse_qs, quote
 
-from fastapi import FastAPI, HTTPException, Query, Body
+from fastapi import FastAPI, HTTPException, Query, Body, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
+from cachetools import TTLCache
+import orjson
 import yt_dlp
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Bytes read from yt-dlp per iteration of the download stream
+CHUNK_SIZE = 1 << 20
+# StreamReader limit for yt-dlp's stdout. Once 2x this is buffered the pipe is
+# no longer read and yt-dlp blocks, so a slow client throttles the download
+# instead of it piling up in memory: at most ~2 MiB per stream.
+PIPE_BUFFER_LIMIT = CHUNK_SIZE
+# Sent with every download. The body is already-compressed media, so proxies
+# must neither buffer it (nginx: X-Accel-Buffering) nor re-encode it (no-transform).
+# For the same reason there is no GZipMiddleware on this app.
+DOWNLOAD_HEADERS = {
+    "Cache-Control": "no-store, no-transform",
+    "X-Accel-Buffering": "no",
+}
+# Nice value for yt-dlp children. On a 1-2 vCPU instance a busy download must
+# not starve the event loop serving /info and health checks.
+YTDLP_NICENESS = 10
+# Seconds between client-disconnect checks while yt-dlp runs
+DISCONNECT_POLL_INTERVAL = 1.0
+
+# Video URL shapes we accept; anything else is rejected before yt-dlp runs
+YT_URL_RE = re.compile(
+    r'https?://(www\.|m\.|music\.)?(youtube\.com/(watch\?|shorts/|live/|embed/)|youtu\.be/)[\w\-?=&%.#+]+',
+    re.IGNORECASE
+)
+
+# Encoded /info responses for cookie-less requests, keyed by video ID
+info_cache = TTLCache(maxsize=512, ttl=600)
+# Cookie-less extractions in flight, keyed by video ID (see extract_shared)
+info_inflight = {}
+# Extractions reused by /download (see pack_video), keyed by video ID. Format
+# URLs stay valid for hours, so a video listed by /info downloads without
+# a second extraction.
+video_cache = TTLCache(maxsize=64, ttl=600)
+
+YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    # Results are cached by video ID alone, so watch?v=X&list=... must
+    # resolve to video X, never to the whole playlist
+    'noplaylist': True,
+    'cachedir': '/tmp/ytdlp-cache',
+}
+# Extractor for cookie-less requests, one per executor thread, so extractor
+# setup and the player cache are paid once per thread instead of once per
+# request. YoutubeDL is not thread-safe, but no two threads share one, so
+# extractions of different videos still run in parallel.
+thread_ydl = threading.local()
+
 app = FastAPI(title="YT Downloader Backend")
 
 # CORS - Allow all origins for the extension
@@ -30,159 +89,412 @@ class VideoRequest(BaseModel):
     url: str
     cookies: Optional[str] = None # Netscape format cookies string
 
-def create_cookie_file(cookies_content: str):
-    """Creates a temporary cookie file and returns the path."""
+def cookies_as_file(cookies_content: Optional[str]) -> Optional[io.StringIO]:
+    """Wraps cookies in an in-memory file object, which YoutubeDL accepts as cookiefile."""
     if not cookies_content:
         logger.warning("No cookies content provided!")
         return None
+    logger.info(f"Using cookies with {len(cookies_content)} chars")
+    # Only the in-process extractor reads this. The yt-dlp child gets the
+    # resulting cookies, scoped per format URL, inside the info JSON, so
+    # nothing is ever written to disk or shared between requests.
+    return io.StringIO(cookies_content)
+
+def validate_url(url: str):
+    """Fails fast on non-YouTube URLs instead of letting the extractor reject them."""
+    if not YT_URL_RE.fullmatch(url):
+        raise HTTPException(status_code=400, detail="Invalid URL")
+
+def video_cache_key(url: str) -> str:
+    """Reduces a YouTube URL to its video ID so equivalent links share a cache entry."""
+    parsed = urlparse(url)
+    host = parsed.netloc.lower()
+    if host.endswith('youtu.be'):
+        video_id = parsed.path.strip('/').split('/')[0]
+        return video_id or url
+
+    video_id = parse_qs(parsed.query).get('v')
+    if video_id:
+        return video_id[0]
+
+    parts = parsed.path.strip('/').split('/')
+    if len(parts) >= 2 and parts[0] in ('shorts', 'live', 'embed'):
+        return parts[1]
+    return url
+
+def get_thread_ydl() -> yt_dlp.YoutubeDL:
+    """This thread's cookie-less YoutubeDL, built on first use."""
+    ydl = getattr(thread_ydl, 'ydl', None)
+    if ydl is None:
+        ydl = thread_ydl.ydl = yt_dlp.YoutubeDL(YDL_OPTS)
+    return ydl
+
+def extract_info(url: str, cookie_file: Optional[io.StringIO]):
+    """
+    Extracts video metadata without downloading. Blocking: always call it via
+    asyncio.to_thread, which also keeps YoutubeDL construction off the event loop.
+    """
+    if cookie_file:
+        # Per-user cookies need their own instance; the player cache on disk is still warm
+        with yt_dlp.YoutubeDL({**YDL_OPTS, 'cookiefile': cookie_file}) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    return get_thread_ydl().extract_info(url, download=False)
+
+def combined_formats(formats: list) -> list:
+    """Formats carrying both video and audio, i.e. downloadable without merging."""
+    return [f for f in formats if f.get('vcodec') != 'none' and f.get('acodec') != 'none']
+
+def pack_video(info_dict: dict) -> dict:
+    """
+    Keeps what /download needs from an extraction: the info JSON for
+    `yt-dlp --load-info-json`, plus the title and per-format ext for headers.
+    """
+    # Subtitle tracks are never downloaded but make up most of the payload
+    info_dict.pop('subtitles', None)
+    info_dict.pop('automatic_captions', None)
+
+    formats = info_dict.get('formats', [])
+    exts = {f['format_id']: f.get('ext') for f in formats}
+    # 'best' is the highest ranked format carrying both video and audio
+    combined = combined_formats(formats)
+    if combined:
+        exts['best'] = combined[-1].get('ext')
+
+    return {
+        'title': info_dict.get('title') or 'video',
+        'exts': exts,
+        'info_json': orjson.dumps(yt_dlp.YoutubeDL.sanitize_info(info_dict), option=orjson.OPT_NON_STR_KEYS),
+    }
+
+def resolve_video(url: str, cookie_file: Optional[io.StringIO]) -> dict:
+    """Extracts a video in-process for /download. Blocking."""
+    return pack_video(extract_info(url, cookie_file))
+
+def attachment_headers(title: str, ext: str) -> dict:
+    """Content-Disposition carrying the video title, with an ASCII fallback name."""
+    return {
+        "Content-Disposition": f"attachment; filename=\"video.{ext}\"; filename*=UTF-8''{quote(title, safe='')}.{ext}"
+    }
+
+async def start_ytdlp(cmd: list, info_json: bytes, stdout):
+    """Starts yt-dlp and feeds it the pre-extracted video info on stdin."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=stdout,
+        # Never PIPE stderr without draining it: once the pipe buffer fills
+        # yt-dlp blocks on write and the download stalls
+        stderr=asyncio.subprocess.DEVNULL,
+        limit=PIPE_BUFFER_LIMIT,
+        # Own process group, so kill_ytdlp() also reaches the ffmpeg it spawns
+        start_new_session=True
+    )
+    # Set from here rather than a preexec_fn, which isn't safe with worker threads around
+    os.setpriority(os.PRIO_PROCESS, proc.pid, YTDLP_NICENESS)
+    proc.stdin.write(info_json)
+    await proc.stdin.drain()
+    proc.stdin.close()
+    return proc
+
+def kill_ytdlp(proc):
+    """Kills a running yt-dlp along with any ffmpeg it started."""
+    if proc.returncode is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+async def kill_on_disconnect(http_request: Request, proc):
+    """
+    Kills yt-dlp once the client goes away; run it as a task next to the download.
+    Otherwise an abandoned download keeps fetching the whole video, e.g. while
+    the stream is stalled and nothing is being sent that could notice.
+    """
+    while proc.returncode is None:
+        if await http_request.is_disconnected():
+            logger.info("Client disconnected, stopping yt-dlp")
+            kill_ytdlp(proc)
+            return
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+async def download_to_file(cmd: list, info_json: bytes, http_request: Request) -> str:
+    """Runs yt-dlp to completion into a temp file and returns its path."""
+    prefix = os.path.join(tempfile.gettempdir(), f"ytdl-{uuid.uuid4()}")
+    pattern = glob.escape(prefix) + ".*"
+    proc = None
     try:
-        logger.info(f"Creating cookie file with {len(cookies_content)} chars")
-        # Create a temp file
-        tf = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt')
-        tf.write(cookies_content)
-        tf.close()
-        return tf.name
-    except Exception as e:
-        logger.error(f"Error creating cookie file: {e}")
-        return None
+        proc = await start_ytdlp(
+            cmd + ["-o", f"{prefix}.%(ext)s", "--no-part"],
+            info_json, stdout=asyncio.subprocess.DEVNULL
+        )
+        watcher = asyncio.create_task(kill_on_disconnect(http_request, proc))
+        try:
+            await proc.wait()
+        finally:
+            watcher.cancel()
+        outputs = glob.glob(pattern)
+        if proc.returncode != 0 or len(outputs) != 1:
+            raise RuntimeError(f"yt-dlp exited with code {proc.returncode}")
+        return outputs[0]
+    except BaseException:
+        if proc:
+            kill_ytdlp(proc)
+        for path in glob.glob(pattern):
+            os.unlink(path)
+        raise
 
-@app.get("/")
-def health_check():
-    return {"status": "ok", "service": "YouTube Downloader Backend"}
+def finish_extraction(key: str, task: asyncio.Task):
+    """Done-callback of an extract_shared() task: caches its result even if every caller left."""
+    info_inflight.pop(key, None)
+    if not task.cancelled() and task.exception() is None:
+        info_cache[key], video_cache[key] = task.result()
 
-@app.post("/info")
-def get_video_info(request: VideoRequest):
+async def extract_shared(url: str, key: str):
     """
-    Fetch metadata for a YouTube video.
+    Cookie-less fetch_video_info() for url. Concurrent callers for the same
+    video await one shared extraction instead of each running their own.
     """
-    url = request.url
-    cookie_file = create_cookie_file(request.cookies)
-    
+    task = info_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(asyncio.to_thread(fetch_video_info, url, None))
+        info_inflight[key] = task
+        task.add_done_callback(lambda t: finish_extraction(key, t))
+    # Shielded so one caller disconnecting doesn't cancel it for the others
+    return await asyncio.shield(task)
+
+@app.get("/")
+async def health_check():
+    return {"status": "ok", "service": "YouTube Downloader Backend"}
+
+def fetch_video_info(url: str, cookies: Optional[str]):
+    """Extracts a video and returns the encoded /info response plus its pack_video() form. Blocking."""
     try:
-        ydl_opts = {
-            'quiet': True, 
-            'no_warnings': True,
-        }
-        if cookie_file:
-            ydl_opts['cookiefile'] = cookie_file
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(url, download=False)
-            
-            formats = []
-            for f in info_dict.get('formats', []):
-                if f.get('vcodec') != 'none' and f.get('acodec') != 'none':
-                     formats.append({
-                        'format_id': f['format_id'],
-                        'ext': f['ext'],
-                        'resolution': f.get('resolution', 'unknown'),
-                        'filesize': f.get('filesize'),
-                        'note': f.get('format_note')
-                    })
-            
-            return {
-                "title": info_dict.get('title'),
-                "thumbnail": info_dict.get('thumbnail'),
-                "formats": formats
+        info_dict = extract_info(url, cookies_as_file(cookies))
+        
+        formats = [
+            {
+                'format_id': f['format_id'],
+                'ext': f['ext'],
+                'resolution': f.get('resolution', 'unknown'),
+                'filesize': f.get('filesize'),
+                'note': f.get('format_note')
             }
+            for f in combined_formats(info_dict.get('formats', []))
+        ]
+        
+        info = {
+            "title": info_dict.get('title'),
+            "thumbnail": info_dict.get('thumbnail'),
+            "formats": formats
+        }
+        # Encoded once here, so cache hits are served without re-serializing
+        return orjson.dumps(info), pack_video(info_dict)
     except Exception as e:
         logger.error(f"Error extracting info: {e}")
         # Return generic error if cookie failed
         if "Sign in" in str(e):
              raise HTTPException(status_code=400, detail="YouTube requires authentication. Please ensure cookies are sent.")
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        # Cleanup temp file
-        if cookie_file and os.path.exists(cookie_file):
-            os.unlink(cookie_file)
 
-import uuid
+@app.post("/info")
+async def get_video_info(request: VideoRequest):
+    """
+    Fetch metadata for a YouTube video.
+    """
+    url = request.url
+    validate_url(url)
+    if request.cookies:
+        # Auth-gated results are per user, never share them through the cache
+        body, _ = await asyncio.to_thread(fetch_video_info, url, request.cookies)
+        return Response(body, media_type="application/json")
+
+    key = video_cache_key(url)
+    body = info_cache.get(key)
+    if body is None:
+        body, _ = await extract_shared(url, key)
+    return Response(body, media_type="application/json")
+
+# Short-lived cookie tokens, one file per token. Not a dict: /prepare_download
+# and /download can land on different gunicorn workers. /dev/shm keeps them in RAM.
+TOKEN_DIR = os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "ytdl-tokens"
+)
+os.makedirs(TOKEN_DIR, mode=0o700, exist_ok=True)
+# Seconds a token stays redeemable. The extension starts its GET right after
+# /prepare_download, so unredeemed tokens are only ever abandoned ones.
+TOKEN_TTL = 300
+# Seconds between sweeps of expired tokens, so /prepare_download doesn't
+# scan the whole directory on every call
+TOKEN_SWEEP_INTERVAL = 60
+# Upper bound on a token's cookies. A YouTube cookie export is a few KiB;
+# anything near this is not one, and would only fill /dev/shm.
+MAX_COOKIES_LEN = 64 * 1024
+last_token_sweep = 0.0
+
+def token_path(token: Optional[str]) -> Optional[str]:
+    """File for a token, or None if it isn't one /prepare_download could have issued."""
+    try:
+        return os.path.join(TOKEN_DIR, uuid.UUID(token).hex)
+    except (TypeError, ValueError):
+        return None
+
+def sweep_tokens():
+    """Deletes expired tokens, including ones left over from before a restart."""
+    cutoff = time.time() - TOKEN_TTL
+    with os.scandir(TOKEN_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                # Redeemed or swept by another worker meanwhile
+                pass
+
+def store_token(cookies: Optional[str]) -> str:
+    """Saves cookies under a new token and returns it. Blocking."""
+    global last_token_sweep
+    if time.time() - last_token_sweep > TOKEN_SWEEP_INTERVAL:
+        last_token_sweep = time.time()
+        sweep_tokens()
+
+    token = str(uuid.uuid4())
+    path = token_path(token)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with open(fd, 'w') as f:
+            f.write(cookies or "")
+    except OSError as e:
+        # Typically /dev/shm full; don't leave a truncated token behind
+        logger.error(f"Error storing token: {e}")
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        raise HTTPException(status_code=503, detail="Too many pending downloads, try again later")
+    return token
 
-# Memory storage for short-lived cookie tokens
-# structure: { "token": "cookie_content" }
-token_store = {}
+def pop_token(token: Optional[str]) -> Optional[str]:
+    """Returns a token's cookies and deletes it, so each token works once. Blocking."""
+    path = token_path(token)
+    if path is None:
+        return None
+    try:
+        with open(path) as f:
+            # Only one request can win the unlink
+            os.unlink(path)
+            if os.fstat(f.fileno()).st_mtime < time.time() - TOKEN_TTL:
+                return None
+            return f.read()
+    except FileNotFoundError:
+        return None
 
 class PrepareRequest(BaseModel):
-    cookies: Optional[str] = None
+    cookies: Optional[str] = Field(None, max_length=MAX_COOKIES_LEN)
 
 @app.post("/prepare_download")
-def prepare_download(request: PrepareRequest):
+async def prepare_download(request: PrepareRequest):
     """
     Store cookies temporarily and return a token.
     Client uses this token to trigger a GET download.
     """
-    token = str(uuid.uuid4())
-    # Store cookies (or None)
-    token_store[token] = request.cookies
+    token = await asyncio.to_thread(store_token, request.cookies)
     return {"token": token}
 
 @app.get("/download")
-def download_video(url: str = Query(..., description="YouTube Video URL"), 
+async def download_video(http_request: Request,
+                   url: str = Query(..., description="YouTube Video URL"), 
                    format_id: str = Query(None),
                    token: str = Query(None)):
     """
     Stream the video download.
     Uses token to retrieve cookies.
     """
-    # Retrieve cookies from store
-    cookies = token_store.get(token)
-    
-    # Clean up token (one-time use)
-    if token and token in token_store:
-        del token_store[token]
-        
-    cookie_file = create_cookie_file(cookies)
+    cookies = await asyncio.to_thread(pop_token, token)
+    validate_url(url)
+    cookie_file = cookies_as_file(cookies)
 
     try:
         f_param = format_id if format_id else 'best'
         
+        # Extract in this process (warm extractor and player caches) and hand the
+        # result to yt-dlp, so the child skips extraction and only fetches bytes.
+        # Usually /info has just done this for the same video.
+        if cookies:
+            video = await asyncio.to_thread(resolve_video, url, cookie_file)
+        else:
+            key = video_cache_key(url)
+            video = video_cache.get(key)
+            if video is None:
+                _, video = await extract_shared(url, key)
+        info_json = video['info_json']
+
         cmd = [
             "yt-dlp",
             "-f", f_param,
-            "-o", "-",
-            url
+            "--load-info-json", "-",
+            # stderr is discarded; don't spend writes on progress lines
+            "--no-progress",
+            "--no-warnings"
         ]
+
+        if '+' in f_param:
+            # Merged formats (e.g. 137+140) are muxed by ffmpeg, which can't write
+            # mp4 to a pipe. Download to disk and serve the finished file instead.
+            path = await download_to_file(cmd, info_json, http_request)
+            # Our own Content-Disposition rather than FileResponse(filename=...),
+            # so both paths send the same ASCII fallback and escaping
+            ext = os.path.splitext(path)[1].lstrip('.')
+            response = FileResponse(
+                path,
+                media_type=mimetypes.guess_type(path)[0] or "application/octet-stream",
+                headers={**attachment_headers(video['title'], ext), **DOWNLOAD_HEADERS},
+                background=BackgroundTask(os.unlink, path)
+            )
+            response.chunk_size = CHUNK_SIZE
+            return response
+
+        cmd.extend(["-o", "-"])
+        # Open subprocess (async, so the event loop can multiplex many streams)
+        proc = await start_ytdlp(cmd, info_json, stdout=asyncio.subprocess.PIPE)
         
-        if cookie_file:
-            cmd.extend(["--cookies", cookie_file])
-
-        # Open subprocess
-        proc = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        
-        def iterfile():
+        async def iterfile():
+            watcher = asyncio.create_task(kill_on_disconnect(http_request, proc))
             try:
-                while True:
-                    data = proc.stdout.read(4096)
-                    if not data:
-                        break
-                    yield data
-                proc.stdout.close()
+                while chunk := await proc.stdout.read(CHUNK_SIZE):
+                    yield chunk
             except Exception as e:
                 logger.error(f"Streaming error: {e}")
-                proc.kill()
             finally:
-                if cookie_file and os.path.exists(cookie_file):
-                    try:
-                        os.unlink(cookie_file)
-                    except:
-                        pass
-
-        headers = {
-            "Content-Disposition": f'attachment; filename="video.mp4"' 
-        }
+                watcher.cancel()
+                # Stopped before EOF (error or cancellation): kill yt-dlp rather
+                # than wait on a child blocked writing to a pipe nobody reads
+                if not proc.stdout.at_eof():
+                    kill_ytdlp(proc)
+                await proc.wait()
+
+        ext = video['exts'].get(f_param) or 'mp4'
+        media_type = mimetypes.guess_type(f"video.{ext}")[0] or "application/octet-stream"
+        headers = {**attachment_headers(video['title'], ext), **DOWNLOAD_HEADERS}
         
-        return StreamingResponse(iterfile(), media_type="video/mp4", headers=headers)
+        return StreamingResponse(iterfile(), media_type=media_type, headers=headers)
 
     except Exception as e:
         logger.error(f"Download error: {e}")
-        if cookie_file and os.path.exists(cookie_file):
-            os.unlink(cookie_file)
         raise HTTPException(status_code=500, detail="Download failed")
 
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+# Serve with preloaded gunicorn workers rather than a single uvicorn process:
+# yt-dlp is imported once in the master and shared copy-on-write, and each
+# worker gets its own event loop. UvicornWorker picks uvloop and httptools.
+#
+#   gunicorn -k uvicorn_worker.UvicornWorker --preload -w ${WEB_CONCURRENCY:-2} \
+#       -b 0.0.0.0:8000 backend.main:app --timeout 0
+#
+# Keep the worker count small. info_cache, info_inflight and video_cache are
+# per worker, so a /download served by a different worker than its /info
+# extracts the video again, and every worker holds its own cached info JSONs
+# and per-thread YoutubeDLs: memory grows with each worker. $(nproc) is also
+# wrong in a container, where it counts the host's CPUs, not the plan's quota.
+#
+# --timeout 0 so the arbiter never kills a worker, and every download it is
+# streaming, over a missed heartbeat.